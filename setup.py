@@ -54,5 +54,5 @@ setup(name="srtm4",
       cmdclass={'develop': CustomDevelop,
                 'build_py': CustomBuildPy},
       include_package_data=True,
-      python_requires='>=2.7',
+      python_requires='>=3.5',
       zip_safe=False)
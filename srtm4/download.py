@@ -9,12 +9,14 @@ Copyright (C) 2016, Carlo de Franchis <carlo.de-franchis@ens-cachan.fr>
 """
 
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
 import zipfile
 import sys
 import os
 
 import requests
-from requests.adapters import HTTPAdapter, Retry, RetryError
+from requests.adapters import HTTPAdapter, Retry
 import filelock
 
 SRTM_URL = 'https://srtm.csi.cgiar.org/wp-content/uploads/files/srtm_5x5/TIFF'
@@ -24,10 +26,13 @@ def _requests_retry_session(
         retries=5,
         backoff_factor=0.3,
         status_forcelist=(500, 502, 503, 504),
+        pool_connections=16,
+        pool_maxsize=32,
 ):
     """
     Makes a requests object with built-in retry handling with
-    exponential back-off on 5xx error codes.
+    exponential back-off on 5xx error codes. Its connection pool is
+    large enough to be shared by the concurrent downloads.
     """
     session = requests.Session()
     retry = Retry(
@@ -37,41 +42,66 @@ def _requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry,
+                          pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
 
 
-def download(to_file, from_url):
+# shared by all downloads so that connections are reused
+_SESSION = _requests_retry_session()
+
+# zip archives bigger than this (in bytes) are spooled to a temporary file
+# instead of being kept in memory, to bound the memory used by the
+# concurrent downloads
+ZIP_MAX_MEMORY = 8 * 1024 * 1024
+
+# (connect, read) timeouts in seconds, so that a stalled download
+# does not block a worker thread forever
+TIMEOUT = (5, 30)
+
+
+def download(to_file, from_url, session=None):
     """
     Download a file from the internet.
 
     Args:
-        to_file: path where to store the downloaded file
+        to_file: path (str or path-like) where to store the downloaded file,
+            or binary file object where to write it
         from_url: url of the file to download
+        session: requests session used for the download, optional.
+            The default is a session shared by all downloads.
 
     Raises:
         RetryError: if the `get` call exceeds the number of retries
             on 5xx codes
         ConnectionError: if the `get` call does not return a 200 code
     """
-    # Use a requests session with retry logic because the server at
+    # The session has retry logic because the server at
     # SRTM_URL sometimes returns 503 responses when overloaded
-    session = _requests_retry_session()
-    r = session.get(from_url, stream=True, verify=False)
+    if session is None:
+        session = _SESSION
+    r = session.get(from_url, stream=True, verify=False, timeout=TIMEOUT)
     if not r.ok:
         raise ConnectionError(
             "Response code {} received for url {}".format(r.status_code, from_url)
         )
     file_size = int(r.headers['content-length'])
-    print("Downloading: {} Bytes: {}".format(to_file, file_size),
+    is_path = not hasattr(to_file, 'write')
+    print("Downloading: {} Bytes: {}".format(to_file if is_path else from_url,
+                                             file_size),
           file=sys.stderr)
 
-    with open(to_file, 'wb') as f:
+    f = open(to_file, 'wb') if is_path else to_file
+    try:
         for chunk in r.iter_content(chunk_size=8192):
             if chunk:  # filter out keep-alive new chunks
                 f.write(chunk)
+    finally:
+        if is_path:
+            f.close()
 
 
 def get_srtm_tile(srtm_tile, out_dir):
@@ -89,56 +119,95 @@ def get_srtm_tile(srtm_tile, out_dir):
     except OSError:
         pass
 
+    # directory level locks, shared with the other processes using out_dir
+    # (including older versions), held around the extraction
     srtm_zip_download_lock = os.path.join(output_dir, 'srtm_zip.lock')
     srtm_tif_write_lock = os.path.join(output_dir, 'srtm_tif.lock')
+    # per tile lock held during the download, so that a tile is downloaded
+    # once while different tiles can be downloaded concurrently
+    srtm_tile_download_lock = os.path.join(output_dir,
+                                           '{}.download.lock'.format(srtm_tile))
+    tif_path = os.path.join(output_dir, '{}.tif'.format(srtm_tile))
 
-    if os.path.exists(os.path.join(output_dir, '{}.tif'.format(srtm_tile))):
+    def wait_for_tif():
         # the tif file is either being written or finished writing
         # locking will ensure it is not being written.
         # Also by construction we won't write on something complete.
         lock_tif = filelock.FileLock(srtm_tif_write_lock)
         lock_tif.acquire()
         lock_tif.release()
-        return
 
-    # download the zip file
-    srtm_tile_url = '{}/{}.zip'.format(SRTM_URL, srtm_tile)
-    zip_path = os.path.join(output_dir, '{}.zip'.format(srtm_tile))
+    if os.path.exists(tif_path):
+        wait_for_tif()
+        return
 
-    lock_zip = filelock.FileLock(srtm_zip_download_lock)
-    lock_zip.acquire()
+    lock_download = filelock.FileLock(srtm_tile_download_lock)
+    lock_download.acquire()
+    try:
+        if os.path.exists(tif_path):
+            # another process or thread downloaded the tile
+            # while we were waiting for the lock
+            wait_for_tif()
+            return
+
+        # download the zip file, in memory up to ZIP_MAX_MEMORY bytes
+        srtm_tile_url = '{}/{}.zip'.format(SRTM_URL, srtm_tile)
+        with tempfile.SpooledTemporaryFile(max_size=ZIP_MAX_MEMORY,
+                                           dir=output_dir) as zip_buf:
+            download(zip_buf, srtm_tile_url)
+
+            # same locking order as the processes that hold the zip lock
+            # during their download
+            lock_zip = filelock.FileLock(srtm_zip_download_lock)
+            lock_zip.acquire()
+            lock_tif = filelock.FileLock(srtm_tif_write_lock)
+            lock_tif.acquire()
+
+            try:
+                # an older version may have extracted the tile while we were
+                # downloading it: never write on something complete
+                if not os.path.exists(tif_path):
+                    # extract the tif file, straight from the downloaded buffer
+                    if zipfile.is_zipfile(zip_buf):
+                        z = zipfile.ZipFile(zip_buf, 'r')
+                        z.extract('{}.tif'.format(srtm_tile), output_dir)
+                    else:
+                        print('{} not available'.format(srtm_tile))
+            finally:
+                # release locks
+                lock_tif.release()
+                lock_zip.release()
+    finally:
+        lock_download.release()
+
+
+def get_srtm_tiles(srtm_tiles, out_dir, max_workers=8, skip_errors=False):
+    """
+    Download and unzip several srtm tiles concurrently.
 
-    if os.path.exists(os.path.join(output_dir, '{}.tif'.format(srtm_tile))):
-        # since the zip lock is returned after the tif lock
-        # if we end up here, it means another process downloaded the zip
-        # and extracted it.
-        # No need to wait on lock_tif
-        lock_zip.release()
-        return
+    Args:
+        srtm_tiles: list of strings following the pattern 'srtm_%02d_%02d'
+        out_dir: directory where to store and extract the srtm tiles
+        max_workers: maximum number of concurrent downloads, optional.
+            The default is 8.
+        skip_errors: if True, tiles whose download raises a ConnectionError
+            are skipped instead of raising, optional. The default is False.
 
-    if os.path.exists(zip_path):
-        print('zip already exists')
-        # Only possibility here is that the previous process was cut short
+    Returns:
+        list of bool: for each tile, False if it was skipped because
+            of a ConnectionError
 
-    try:
-        download(zip_path, srtm_tile_url)
-    except (ConnectionError, RetryError) as e:
-        lock_zip.release()
-        raise e
-
-    lock_tif = filelock.FileLock(srtm_tif_write_lock)
-    lock_tif.acquire()
-
-    # extract the tif file
-    if zipfile.is_zipfile(zip_path):
-        z = zipfile.ZipFile(zip_path, 'r')
-        z.extract('{}.tif'.format(srtm_tile), output_dir)
-    else:
-        print('{} not available'.format(srtm_tile))
-
-    # remove the zip file
-    os.remove(zip_path)
-
-    # release locks
-    lock_tif.release()
-    lock_zip.release()
+    Raises:
+        ConnectionError: if a download fails and skip_errors is False
+    """
+    def fetch(srtm_tile):
+        try:
+            get_srtm_tile(srtm_tile, out_dir)
+        except ConnectionError:
+            if not skip_errors:
+                raise
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fetch, srtm_tiles))
@@ -1,3 +1,4 @@
+import functools
 import os
 import subprocess
 
@@ -13,6 +14,13 @@ if not SRTM_DIR:
 BIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
 GEOID = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
 
+# use the srtm4 binaries instead of the pure python code, e.g. for parity checks
+_USE_BINARY = bool(os.getenv('SRTM4_USE_BINARY'))
+
+# set when the EGM96 grid of PROJ couldn't be used, e.g. offline, so that
+# the next calls go straight to the srtm4 binary
+_PROJ_FAILED = False
+
 
 def lon_lats_str(lon, lat):
     """
@@ -33,7 +41,54 @@ def lon_lats_str(lon, lat):
     return lon_lats
 
 
-def srtm4_which_tile(lon, lat):
+def id2name(lon_id, lat_id):
+    """
+    Convert the lon, lat ids to the corresponding tile name.
+
+    Args:
+        lon_id (int) and lat_id (int)
+    Returns:
+        tile_name "srtm_lonid_latid" (str)
+    """
+    return 'srtm_{:02d}_{:02d}'.format(lon_id, lat_id)
+
+
+@functools.lru_cache(maxsize=4096)
+def _tile_id_scalar(lon_q, lat_q):
+    """
+    Convert 5 degrees bin indices to srtm tile ids.
+
+    Args:
+        lon_q: int, (lon + 180) // 5
+        lat_q: int, (60 - lat) // 5, with lat clipped to [-60, 60]
+    Returns:
+        lon_id (int) and lat_id (int)
+    """
+    return lon_q % 72 + 1, min(lat_q + 1, 24)
+
+
+def _tile_id(lon, lat):
+    """
+    Compute the srtm tile ids of a (list of) point(s), following the
+    conventions of the srtm4_which_tile binary.
+
+    Args:
+        lon, lat: arrays of longitudes and latitudes (same length), or single
+            longitude and latitude
+
+    Returns:
+        lon_id, lat_id: arrays of int
+            lon_id: 1 to 72 from -180 to 180 with a step of 5 degrees
+            lat_id: 1 to 24 from 60 to -60 with a step of 5 degrees
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -60, 60)
+    lon_id = np.mod(np.floor((lon + 180) / 5), 72).astype(int) + 1
+    lat_id = np.minimum(np.floor((60 - lat) / 5).astype(int) + 1, 24)
+    return lon_id, lat_id
+
+
+def _srtm4_which_tile_binary(lon, lat):
     """
     Determine the srtm tiles needed to cover the (list of) point(s)
     by running the srtm4_which_tile binary
@@ -46,43 +101,102 @@ def srtm4_which_tile(lon, lat):
         list of str: list of srtm tile names
     """
     # run the srtm4_which_tile binary and feed it from stdin
-    lon_lats = lon_lats_str(lon, lat)
     p = subprocess.Popen(['srtm4_which_tile'], stdin=subprocess.PIPE,
                          stdout=subprocess.PIPE,
                          env={'PATH': BIN, 'SRTM4_CACHE': SRTM_DIR})
-    outs, errs = p.communicate(input=lon_lats.encode())
+    outs, errs = p.communicate(input=lon_lats_str(lon, lat).encode())
 
     # read the list of needed tiles
     srtm_tiles = outs.decode().split()
     return srtm_tiles
 
 
-def srtm4(lon, lat):
+def srtm4_which_tile(lon, lat):
     """
-    Gives the SRTM height of a (list of) point(s).
+    Determine the srtm tiles needed to cover the (list of) point(s)
 
     Args:
         lon, lat: lists of longitudes and latitudes (same length), or single
             longitude and latitude
 
     Returns:
-        height(s) in meters above the WGS84 ellipsoid (not the EGM96 geoid)
+        list of str: list of srtm tile names
+    """
+    if _USE_BINARY:
+        return _srtm4_which_tile_binary(lon, lat)
+
+    if np.ndim(lon) == 0:
+        lat = min(max(lat, -60), 60)
+        return [id2name(*_tile_id_scalar(int((lon + 180) // 5),
+                                         int((60 - lat) // 5)))]
+
+    lon_ids, lat_ids = _tile_id(lon, lat)
+    return [id2name(a, b) for a, b in zip(lon_ids.tolist(), lat_ids.tolist())]
+
+
+def _srtm4_binary(lon, lat):
+    """
+    Gives the SRTM height of a (list of) point(s) by running the srtm4 binary.
+
+    Args:
+        lon, lat: lists of longitudes and latitudes (same length), or single
+            longitude and latitude
+
+    Returns:
+        (array): 1D array of heights in meters above the WGS84 ellipsoid
     """
     # get the names of srtm_tiles needed
     srtm_tiles = srtm4_which_tile(lon, lat)
 
     # download the tiles if not already there
-    for srtm_tile in set(srtm_tiles):
-        download.get_srtm_tile(srtm_tile, SRTM_DIR)
+    download.get_srtm_tiles(set(srtm_tiles), SRTM_DIR)
 
     # run the srtm4 binary and feed it from stdin
-    lon_lats = lon_lats_str(lon, lat)
     p = subprocess.Popen(['srtm4'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                          env={'PATH': BIN,
                               'SRTM4_CACHE': SRTM_DIR,
                               'GEOID_PATH': GEOID})
-    outs, errs = p.communicate(input=lon_lats.encode())
+    outs, errs = p.communicate(input=lon_lats_str(lon, lat).encode())
 
     # return the altitudes
-    alts = list(map(float, outs.decode().split()))
-    return alts if isinstance(lon, (list, np.ndarray)) else alts[0]
+    return np.fromstring(outs.decode(), dtype=np.float64, sep=' ')
+
+
+def srtm4(lon, lat):
+    """
+    Gives the SRTM height of a (list of) point(s).
+
+    The heights are interpolated in-process when the optional `crop`
+    requirements are installed and the EGM96 grid of PROJ can be used,
+    otherwise the srtm4 binary is used. The geoid correction differs
+    between the two: the in-process path interpolates the PROJ EGM96 grid
+    bilinearly, the binary interpolates data/egm96-15.pgm with a cubic.
+    The heights may thus differ by centimeters, up to decimeters where the
+    geoid is rough. Set the SRTM4_USE_BINARY environment variable to always
+    use the binary.
+
+    Args:
+        lon, lat: lists of longitudes and latitudes (same length), or single
+            longitude and latitude
+
+    Returns:
+        height(s) in meters above the WGS84 ellipsoid (not the EGM96 geoid)
+    """
+    global _PROJ_FAILED
+
+    alts = None
+    if not (_USE_BINARY or _PROJ_FAILED):
+        try:
+            from pyproj.exceptions import ProjError
+            from srtm4.raster import interpolate
+        except (ImportError, AttributeError):  # optional requirements not available
+            pass
+        else:
+            try:
+                alts = interpolate(lon, lat)
+            except ProjError:  # e.g. the EGM96 grid can't be downloaded
+                _PROJ_FAILED = True
+
+    if alts is None:
+        alts = _srtm4_binary(lon, lat)
+    return alts.tolist() if isinstance(lon, (list, np.ndarray)) else float(alts[0])
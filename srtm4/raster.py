@@ -5,7 +5,12 @@ The AREA_OR_POINT tag is wrong in the geotiff meta.
 In this code, we do not touch the tag, but only correct the effect by taking into
 account that the transform's origin is the center of the first pixel.
 """
+import atexit
+import collections
+import functools
 import os
+import threading
+import weakref
 import numpy as np
 
 import affine
@@ -16,12 +21,28 @@ pyproj.network.set_network_enabled(active=True)
 
 import rasterio
 
-from srtm4.download import get_srtm_tile
-from srtm4.point import srtm4_which_tile, SRTM_DIR
+from srtm4.download import get_srtm_tiles
+from srtm4.point import srtm4_which_tile, id2name, _tile_id, SRTM_DIR
 
 TILE_SIZE = 6000
 # degree resolution
 RES = 3 / 3600
+# sea water pixels are labeled as -32768
+SEA_VALUE = -32768
+
+# opened tiles, one cache per thread since a rasterio dataset can't be
+# read from several threads at once
+_THREAD_TILES = threading.local()
+# weak references to the caches of all the threads, to close them at exit
+_ALL_TILES = []
+_ALL_TILES_LOCK = threading.Lock()
+MAX_OPEN_TILES = 64
+
+# number of points transformed at once by pyproj in to_ellipsoid
+CHUNK = 1 << 20
+
+# degree resolution of the EGM96 grid used by pyproj (15 arc minutes)
+GEOID_RES = 0.25
 
 def name2id(tile_name):
     """
@@ -40,18 +61,6 @@ def name2id(tile_name):
     return lon_id, lat_id
 
 
-def id2name(lon_id, lat_id):
-    """
-    Convert the lon, lat ids to the corresponding tile name. 
-
-    Args: 
-        lon_id (int) and lat_id (int)
-    Returns:
-        tile_name "srtm_lonid_latid" (str)
-    """
-    return 'srtm_{:02d}_{:02d}'.format(lon_id, lat_id)
-
-
 def assert_interval(interval):
     """Assert that the passed tuple is an interval.
 
@@ -125,31 +134,299 @@ def adjust_bounds_to_px_grid(bounds):
     return adjusted_bounds, transform, shape
 
 
+@functools.lru_cache(maxsize=None)
+def _transformer(src, dst):
+    """
+    Build a pyproj transformer, cached so that it is built only once.
+
+    Args:
+        src, dst: str, source and destination crs definitions
+    Returns:
+        pyproj.Transformer
+    """
+    return pyproj.Transformer.from_crs(pyproj.CRS(src), pyproj.CRS(dst))
+
+
 def to_ellipsoid(lons, lats, alts):
     """
     Convert geoidal heights to ellipsoidal heights.
 
     Args:
-        lats, lons (array): 1D arrays of latitudes and longitudes
-        alts (array): 1D array of altitudes, referenced to the geoid
+        lats, lons (array): arrays of latitudes and longitudes
+        alts (array): array of altitudes, referenced to the geoid
 
     Returns:
         (array): altitudes referenced to the ellipsoid
+
+    Raises:
+        pyproj.exceptions.ProjError: if the EGM96 grid of PROJ could not be
+            used, e.g. when it can't be downloaded
     """
     dtype = alts.dtype
-    # WGS84 with ellipsoid height as vertical axis
-    ellipsoid = pyproj.CRS.from_epsg(4979)
+    shape = alts.shape
+
+    # from WGS84 with Gravity-related height (EGM96)
+    # to WGS84 with ellipsoid height as vertical axis
+    trf = _transformer("EPSG:4326+5773", "EPSG:4979")
+
+    # transform by chunks to bound the memory used by pyproj temporaries
+    lons = np.ravel(lons)
+    lats = np.ravel(lats)
+    alts = np.ravel(alts)
+    out = np.empty(alts.shape, dtype=dtype)
+    modified = False
+    for i in range(0, alts.size, CHUNK):
+        chunk = slice(i, i + CHUNK)
+        new_alt = trf.transform(lats[chunk], lons[chunk], alts[chunk],
+                                errcheck=True)[-1]
+        if not np.all(np.isfinite(new_alt)):
+            raise pyproj.exceptions.ProjError("geoid to ellipsoid transformation failed")
+        modified = modified or np.any(new_alt != alts[chunk])
+
+        # round in place, the cast happens while copying into the output
+        np.around(new_alt, 5, out=new_alt)
+        out[chunk] = new_alt
+
+    # check that pyproj actually modified the values, it doesn't when
+    # it falls back to a transformation without the geoid grid
+    if not modified:
+        raise pyproj.exceptions.ProjError("geoid grid not applied")
+    return out.reshape(shape)
+
+
+def _interpolation_weights(coords, nodes_min, step, n_nodes):
+    """
+    Locate coordinates on a regular 1D grid of nodes for linear interpolation.
+
+    Args:
+        coords: 1D array of coordinates
+        nodes_min: coordinate of the first node
+        step: spacing of the nodes, may be negative
+        n_nodes: number of nodes (at least 2)
+    Returns:
+        i0: 1D int array, index of the node before each coordinate
+        w: 1D float array, weight of the node after each coordinate
+    """
+    pos = (coords - nodes_min) / step
+    i0 = np.clip(np.floor(pos).astype(int), 0, n_nodes - 2)
+    return i0, pos - i0
+
+
+def to_ellipsoid_grid(raster, transform):
+    """
+    Convert the geoidal heights of a north up raster to ellipsoidal heights.
+
+    pyproj is only called at the nodes of the EGM96 grid covering the raster,
+    the geoid undulation is then interpolated bilinearly at the pixel centers,
+    as pyproj does between these nodes.
+
+    Args:
+        raster (array): 2D array of altitudes, referenced to the geoid
+        transform: affine.Affine transform in px_is_area convention
+
+    Returns:
+        (array): altitudes referenced to the ellipsoid
+
+    Raises:
+        pyproj.exceptions.ProjError: if the EGM96 grid of PROJ could not be
+            used, e.g. when it can't be downloaded
+    """
+    height, width = raster.shape
+    res_x, _, x_0, _, res_y, y_0 = transform[:6]
+    lon = res_x * (np.arange(width) + 0.5) + x_0
+    lat = res_y * (np.arange(height) + 0.5) + y_0
+
+    # EGM96 grid nodes surrounding the raster, at least two per axis
+    def nodes(coords):
+        low = np.floor(coords.min() / GEOID_RES)
+        up = max(np.ceil(coords.max() / GEOID_RES), low + 1)
+        return GEOID_RES * np.arange(low, up + 1)
+
+    lon_nodes = nodes(lon)
+    lat_nodes = nodes(lat)
+
+    # geoid undulation at the nodes
+    trf = _transformer("EPSG:4326+5773", "EPSG:4979")
+    lon_grid, lat_grid = np.meshgrid(lon_nodes, lat_nodes)
+    und_nodes = trf.transform(lat_grid, lon_grid, np.zeros(lon_grid.shape),
+                              errcheck=True)[-1]
+
+    # check that pyproj actually used the geoid grid, as in to_ellipsoid
+    if not np.all(np.isfinite(und_nodes)):
+        raise pyproj.exceptions.ProjError("geoid to ellipsoid transformation failed")
+    if not np.any(und_nodes != 0):
+        raise pyproj.exceptions.ProjError("geoid grid not applied")
+
+    # bilinear interpolation, along the longitudes then along the latitudes
+    i0, wx = _interpolation_weights(lon, lon_nodes[0], GEOID_RES, len(lon_nodes))
+    j0, wy = _interpolation_weights(lat, lat_nodes[0], GEOID_RES, len(lat_nodes))
+    und_rows = (1 - wx) * und_nodes[:, i0] + wx * und_nodes[:, i0 + 1]
+    und = (1 - wy)[:, None] * und_rows[j0] + wy[:, None] * und_rows[j0 + 1]
+
+    und += raster
+    np.around(und, 5, out=und)
+    return und.astype(raster.dtype)
+
+
+def _thread_tiles():
+    """
+    Get the tile cache of the current thread.
+
+    Returns:
+        datasets: OrderedDict tile path -> opened rasterio dataset,
+            in least recently used order
+        users: Counter tile path -> number of callers using the dataset
+    """
+    if not hasattr(_THREAD_TILES, 'datasets'):
+        _THREAD_TILES.datasets = collections.OrderedDict()
+        _THREAD_TILES.users = collections.Counter()
+        with _ALL_TILES_LOCK:
+            _ALL_TILES.append(weakref.ref(_THREAD_TILES.datasets))
+    return _THREAD_TILES.datasets, _THREAD_TILES.users
+
+
+def _open_tile(path):
+    """
+    Open a tile with rasterio, reusing the dataset opened by a previous call
+    in the same thread. The dataset must be handed back with _release_tiles
+    once used, and only read from the calling thread.
+
+    Args:
+        path: path of the tile GeoTIFF file
+    Returns:
+        opened rasterio dataset
+    """
+    datasets, users = _thread_tiles()
+    db = datasets.pop(path, None)
+    if db is None or db.closed:
+        db = rasterio.open(path, 'r')
+    datasets[path] = db
+    users[path] += 1
+    return db
+
+
+def _release_tiles(paths):
+    """
+    Hand back datasets obtained with _open_tile. At most MAX_OPEN_TILES
+    datasets are then kept open by the thread: the least recently used ones
+    that are not used anymore are closed first.
+
+    Args:
+        paths: list of the paths passed to _open_tile
+    """
+    datasets, users = _thread_tiles()
+    for path in paths:
+        users[path] -= 1
+        if users[path] <= 0:
+            del users[path]
+
+    excess = len(datasets) - MAX_OPEN_TILES
+    for path in list(datasets):
+        if excess <= 0:
+            break
+        if path not in users:
+            datasets.pop(path).close()
+            excess -= 1
+
+
+@atexit.register
+def _close_tiles():
+    """Close all the datasets opened by _open_tile, in all the threads."""
+    with _ALL_TILES_LOCK:
+        for ref in _ALL_TILES:
+            datasets = ref()
+            while datasets:
+                _, db = datasets.popitem()
+                db.close()
+        del _ALL_TILES[:]
+
+
+def bilinear_interpolation(band, col, row):
+    """
+    Bilinear interpolation of a tile band at (non integer) pixel positions.
+    Positions are clamped to the band and sea water pixels count as 0,
+    as in the srtm4 binary.
+
+    Args:
+        band: 2D array of the tile
+        col, row: 1D arrays of pixel positions, the origin being the center
+            of the first pixel
+    Returns:
+        1D float64 array of interpolated values
+    """
+    h, w = band.shape
+    col0 = np.floor(col).astype(int)
+    row0 = np.floor(row).astype(int)
+    x = col - col0
+    y = row - row0
+
+    def getpixel(i, j):
+        val = band[np.clip(j, 0, h - 1), np.clip(i, 0, w - 1)].astype(np.float64)
+        val[val == SEA_VALUE] = 0
+        return val
+
+    a = getpixel(col0, row0)
+    b = getpixel(col0 + 1, row0)
+    c = getpixel(col0, row0 + 1)
+    d = getpixel(col0 + 1, row0 + 1)
+    return a * (1 - x) * (1 - y) + b * x * (1 - y) + c * (1 - x) * y + d * x * y
+
+
+def interpolate(lon, lat):
+    """
+    Gives the SRTM height of a (list of) point(s), without calling the
+    srtm4 binaries.
+
+    Args:
+        lon, lat: lists of longitudes and latitudes (same length), or single
+            longitude and latitude
+
+    Returns:
+        (array): 1D array of heights in meters above the WGS84 ellipsoid.
+            Points out of coverage get NaN.
+    """
+    lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+    lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+    alts = np.full(lon.shape, np.nan)
+
+    # group the covered points by tile
+    covered = np.flatnonzero(np.abs(lat) <= 60)
+    lon_ids, lat_ids = _tile_id(lon[covered], lat[covered])
+    tiles, inverse = np.unique(lon_ids * 100 + lat_ids, return_inverse=True)
+    tile_names = [id2name(t // 100, t % 100) for t in tiles.tolist()]
+
+    # download concurrently the tiles that are not on the disk yet
+    get_srtm_tiles(tile_names, SRTM_DIR, max_workers=16)
+
+    for k, tile_name in enumerate(tile_names):
+        path = os.path.join(SRTM_DIR, tile_name + '.tif')
+        if not os.path.exists(path):  # no tile over the sea
+            continue
+        idx = covered[inverse == k]
 
-    # WGS84 with Gravity-related height (EGM96)
-    geoid = pyproj.CRS("EPSG:4326+5773")
+        # position in the tile, the origin being the center of the first pixel
+        col = np.mod(lon[idx] + 180, 5) / RES
+        row = np.mod(60 - lat[idx], 5) / RES
 
-    trf = pyproj.Transformer.from_crs(geoid, ellipsoid)
+        # read only the window surrounding the points
+        db = _open_tile(path)
+        try:
+            col_0 = int(np.floor(col.min()))
+            row_0 = int(np.floor(row.min()))
+            col_1 = min(int(np.floor(col.max())) + 1, db.width - 1)
+            row_1 = min(int(np.floor(row.max())) + 1, db.height - 1)
+            band = db.read(1, window=((row_0, row_1 + 1), (col_0, col_1 + 1)))
+        finally:
+            _release_tiles([path])
 
-    # check that pyproj actually modified the values
-    new_alt = trf.transform(lats, lons, alts)[-1]
+        # the window only stops short of the neighbours of the points on the
+        # tile border, so clamping to the window is clamping to the tile
+        alts[idx] = bilinear_interpolation(band, col - col_0, row - row_0)
 
-    assert np.any(new_alt != alts)
-    return np.around(new_alt, 5).astype(dtype)
+    valid = ~np.isnan(alts)
+    if np.any(valid):
+        alts[valid] = to_ellipsoid(lon[valid], lat[valid], alts[valid])
+    return alts
 
 
 def intersect_bounds(one_bound, other_bound):
@@ -162,18 +439,14 @@ def intersect_bounds(one_bound, other_bound):
         tuple of float. 
         If no intersection is found, tuple of None returned. 
     """
-    one_w, one_s, one_e, one_n = one_bound
-    other_w, other_s, other_e, other_n = other_bound
+    int_w = max(one_bound[0], other_bound[0])
+    int_s = max(one_bound[1], other_bound[1])
+    int_e = min(one_bound[2], other_bound[2])
+    int_n = min(one_bound[3], other_bound[3])
 
-    int_w, int_e = intersect_intervals((one_w, one_e), (other_w, other_e))
-    int_s, int_n = intersect_intervals((one_s, one_n), (other_s, other_n))
-
-    intersection_bounds = int_w, int_s, int_e, int_n
-
-    if np.any([a is None for a in intersection_bounds]):
-        return (None, None, None, None)
-    else:
-        return intersection_bounds
+    if int_e > int_w and int_n > int_s:
+        return int_w, int_s, int_e, int_n
+    return (None, None, None, None)
 
 
 def special_round(val, eps=1e-2):
@@ -189,8 +462,8 @@ def special_round(val, eps=1e-2):
     Returns: 
         rounded: int, rounded value. 
     """
-    rounded = round(val)
-    assert rounded - val < eps, "Big rounding error induced !"
+    rounded = int(val + 0.5) if val >= 0 else int(val - 0.5)
+    assert abs(rounded - val) < eps, "Big rounding error induced !"
     return rounded
 
 
@@ -202,7 +475,7 @@ def get_px_region(geo_px_bounds, transform, transform_is_area=True):
         geo_px_bounds: tuple (lon_min, lat_min, lon_max, lat_max)
                        Geographic coords bounds previously fitted on the 
                        center of the pixels.
-        transform: affine.Affine transform.
+        transform: affine.Affine transform, north up (no rotation).
         transform_is_area: boolean indicating if the transform's origin
                            in the pixel coordinates is the upper left corner of the 
                            first pixel(True) or the center of the first_pixel(False), optional.
@@ -210,24 +483,48 @@ def get_px_region(geo_px_bounds, transform, transform_is_area=True):
     Returns: 
         tuple (col, row, w, h) of the px region in the image.
     """
-    window = rasterio.windows.from_bounds(*geo_px_bounds, transform)
+    west, south, east, north = geo_px_bounds
+    res_x, _, x_0, _, res_y, y_0 = transform[:6]
 
     if transform_is_area:
         off = 0.5
     else:
         off = 0
 
-    row, col = special_round(
-        window.row_off - off), special_round(window.col_off - off)
-    h, w = special_round(window.height), special_round(window.width)
+    # same as rasterio.windows.from_bounds, for an axis aligned transform
+    row = special_round((north - y_0) / res_y - off)
+    col = special_round((west - x_0) / res_x - off)
+    h = special_round((south - north) / res_y)
+    w = special_round((east - west) / res_x)
 
     return (col, row, w, h)
 
 
+@functools.lru_cache(maxsize=256)
+def _px_region_cached(geo_px_bounds, transform_coefs, transform_is_area):
+    """
+    Memoized get_px_region, so that repeated crops reuse the windows.
+
+    Args:
+        geo_px_bounds: tuple (lon_min, lat_min, lon_max, lat_max)
+        transform_coefs: tuple of the 6 affine.Affine coefficients
+        transform_is_area: boolean, see get_px_region
+    Returns:
+        tuple (col, row, w, h) of the px region in the image.
+    """
+    return get_px_region(geo_px_bounds, affine.Affine(*transform_coefs),
+                         transform_is_area)
+
+
 def merge(datasets, transform, shape, nodata=np.nan, dtype="f4"):
     """
     Merge multiple rasterio datasets into a final array.
 
+    rasterio.merge.merge is not used: it would take the transforms of the
+    SRTM90 tiles at face value, while their origin is the center of the first
+    pixel (see the module docstring), and snap the windows with a half pixel
+    shift. Here the windows are computed exactly and checked by special_round.
+
     Args:
         datasets: list of opened rasterio datasets.
         transform: affine.Affine transform of the final image in px_is_area convention.
@@ -248,11 +545,10 @@ def merge(datasets, transform, shape, nodata=np.nan, dtype="f4"):
     dst_e, dst_s = transform * (dst_width + off, dst_height + off)
 
     dst_bounds = (dst_w, dst_s, dst_e, dst_n)
+    nodata_is_nan = np.isnan(nodata)
 
-    def copyto(old_data, new_data, old_nodata, new_nodata):
-        mask = np.logical_and(old_nodata, ~new_nodata)
-        old_data[mask] = new_data[mask]
-
+    # compute the regions to copy first, to size the scratch buffers
+    regions = []
     for dataset in datasets:
         # compute intersection
         int_bounds = intersect_bounds(dst_bounds, dataset.bounds)
@@ -262,27 +558,54 @@ def merge(datasets, transform, shape, nodata=np.nan, dtype="f4"):
             continue
 
         # compute dest window in dst_array
+        dst_px = _px_region_cached(int_bounds, tuple(transform)[:6], True)
+        src_px = _px_region_cached(int_bounds, tuple(dataset.transform)[:6],
+                                   False)
+        regions.append((dataset, dst_px, src_px))
 
-        col_dst, row_dst, width_dst, height_dst = get_px_region(
-            int_bounds, transform)
-        col, row, width, height = get_px_region(int_bounds, dataset.transform,
-                                                transform_is_area=False)
+    if not regions:
+        return dst_array
+
+    # flat scratch buffers reused for every dataset
+    max_size = max(width * height for _, _, (_, _, width, height) in regions)
+    read_buf = np.empty(max_size, dtype=regions[0][0].dtypes[0])
+    sel_buf = np.empty(max_size, dtype=bool)
+    valid_buf = np.empty(max_size, dtype=bool)
+
+    for dataset, dst_px, src_px in regions:
+        col_dst, row_dst, width_dst, height_dst = dst_px
+        col, row, width, height = src_px
+        size = width * height
 
         # read source
+        if read_buf.dtype != dataset.dtypes[0]:
+            read_buf = np.empty(max_size, dtype=dataset.dtypes[0])
         tmp_array = dataset.read(1,
                                  window=((row, row + height),
-                                         (col, col + width))
+                                         (col, col + width)),
+                                 out=read_buf[:size].reshape(height, width)
                                  )
 
         # write tmp_array into dst_region
         dst_region = dst_array[row_dst: row_dst +
                                height_dst, col_dst: col_dst + width_dst]
-        mask_region = np.isnan(dst_region) if np.isnan(
-            nodata) else dst_region == nodata
-        mask_tmp = np.isnan(tmp_array) if np.isnan(
-            dataset.nodata) else tmp_array == dataset.nodata
 
-        copyto(dst_region, tmp_array.astype(dtype), mask_region, mask_tmp)
+        # select pixels still empty in dst_region and valid in tmp_array
+        sel = sel_buf[:size].reshape(height, width)
+        if nodata_is_nan:
+            np.isnan(dst_region, out=sel)
+        else:
+            np.equal(dst_region, nodata, out=sel)
+        valid = valid_buf[:size].reshape(height, width)
+        if np.isnan(dataset.nodata):
+            np.isnan(tmp_array, out=valid)
+            np.logical_not(valid, out=valid)
+        else:
+            np.not_equal(tmp_array, dataset.nodata, out=valid)
+        sel &= valid
+
+        # the cast to dtype happens during the copy, without a temporary array
+        np.copyto(dst_region, tmp_array, where=sel, casting='unsafe')
 
     return dst_array
 
@@ -341,50 +664,43 @@ def crop_at_continous_lon_limits(bounds, datum="ellipsoidal"):
     assert lat_ids[0] <= lat_ids[1]
     lat_id = np.arange(lat_ids[0], lat_ids[1] + 1)
 
-    datasets = []
-    for lat in lat_id:
-        for lon in lon_id:
-            try:
-                # download tile if not already on the disk
-                get_srtm_tile(id2name(lon, lat), SRTM_DIR)
-            except ConnectionError:
-                continue
-            else:
-                # open, read relevant rows and cols
-                tile_name = os.path.join(SRTM_DIR, id2name(lon, lat) + '.tif')
-                db = rasterio.open(tile_name, 'r')
-                datasets.append(db)
-                
-    if len(datasets) == 0:
-        raise ValueError("No DEM found on bounds")
+    # download all the tiles first, then open them
+    needed = [id2name(lon, lat) for lat in lat_id for lon in lon_id]
+    available = get_srtm_tiles(needed, SRTM_DIR, max_workers=16,
+                               skip_errors=True)
 
-    raster = merge(datasets, transform=transform, shape=dem_shape)
+    tile_names = [os.path.join(SRTM_DIR, srtm_tile + '.tif')
+                  for srtm_tile, ok in zip(needed, available) if ok]
 
-    if datum == "ellipsoidal":
-        shape = raster.shape
+    if len(tile_names) == 0:
+        raise ValueError("No DEM found on bounds")
 
-        # get dem points in crs
-        col, row = np.meshgrid(
-            np.arange(shape[1]), np.arange(shape[0]))
+    # open, read relevant rows and cols
+    datasets = []
+    try:
+        for tile_name in tile_names:
+            datasets.append(_open_tile(tile_name))
+        raster = merge(datasets, transform=transform, shape=dem_shape)
+    finally:
+        _release_tiles(tile_names[:len(datasets)])
 
-        col = col.ravel() + 0.5
-        row = row.ravel() + 0.5
+    # no datum shift needed when there is no data at all
+    if datum == "ellipsoidal" and not np.all(np.isnan(raster)):
+        raster = to_ellipsoid_grid(raster, transform)
 
-        # to earth coordinates
-        lon, lat = transform * (col, row)
-        # reshape
-        lon = lon.reshape(shape)
-        lat = lat.reshape(shape)
-        
-        raster = to_ellipsoid(lon, lat, raster)
-    
     crs = rasterio.crs.CRS.from_epsg(4326)
     return raster, transform, crs
      
 
 
 def wrap_lon(lon):
-    """Wrap the longitude to the [-180, 180[ interval."""
+    """Wrap the longitude(s) to the [-180, 180[ interval."""
+    if isinstance(lon, np.ndarray):
+        # single output buffer, the modulo and subtraction are done in place
+        out = lon + 180
+        np.mod(out, 360, out=out)
+        out -= 180
+        return out
     return (lon + 180) % 360 - 180
 
 
@@ -451,10 +767,14 @@ def write_crop_to_file(array, transform, crs, path):
                    transform=transform,
                    crs=crs,
                    tiled=True,
-                   compress="deflate",
+                   compress="zstd",
+                   zstd_level=3,
                    predictor=2,
                    blockxsize=256,
-                   blockysize=256)
+                   blockysize=256,
+                   # compress the blocks on all the cores
+                   num_threads="ALL_CPUS",
+                   bigtiff="IF_SAFER")
 
     with rasterio.open(path, "w", **profile) as f:
         f.write(array, 1)
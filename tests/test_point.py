@@ -15,4 +15,61 @@ def test_srtm4(longitude, latitude, exp_altitude, tmp_path, monkeypatch):
     import srtm4
 
     altitude = srtm4.srtm4(longitude, latitude)
-    assert altitude == exp_altitude
+    # the in-process geoid (bilinear on the PROJ EGM96 grid) differs from the
+    # binary's (cubic on data/egm96-15.pgm) by cm to dm where the geoid is
+    # rough, but it is smooth at this point
+    assert altitude == pytest.approx(exp_altitude, abs=1e-2)
+
+
+def test_srtm4_without_geoid_grid(tmp_path, monkeypatch):
+    monkeypatch.setenv("SRTM4_CACHE", str(tmp_path))
+    import pyproj
+    import srtm4.point
+    import srtm4.raster
+
+    def to_ellipsoid(lons, lats, alts):
+        raise pyproj.exceptions.ProjError("no grid")
+
+    # the binary is used when the PROJ grid is not available
+    monkeypatch.setattr(srtm4.raster, "to_ellipsoid", to_ellipsoid)
+    monkeypatch.setattr(srtm4.point, "_PROJ_FAILED", False)
+    assert srtm4.srtm4(2, 48) == 174.613
+
+    # and directly for the next calls
+    assert srtm4.point._PROJ_FAILED
+    monkeypatch.setattr(srtm4.raster, "interpolate", None)
+    assert srtm4.srtm4(2, 48) == 174.613
+
+
+@pytest.mark.parametrize(
+    "longitude, latitude",
+    [
+        (2, 48),
+        ([2, -180, 179.99, -0.01], [48, 60, -60, -0.01]),
+        (np.array([21.33, -112]), np.array([-3.78, 16])),
+    ],
+)
+def test_srtm4_which_tile(longitude, latitude, monkeypatch):
+    import srtm4.point
+
+    tiles = srtm4.point.srtm4_which_tile(longitude, latitude)
+    monkeypatch.setattr(srtm4.point, "_USE_BINARY", True)
+    assert tiles == srtm4.point.srtm4_which_tile(longitude, latitude)
+
+
+def test_srtm4_download_error(tmp_path, monkeypatch):
+    import srtm4
+    import srtm4.download
+    import srtm4.point
+
+    def download(to_file, from_url, session=None):
+        raise ConnectionError("no network")
+
+    # empty cache, failing downloads
+    monkeypatch.setattr(srtm4.point, "SRTM_DIR", str(tmp_path))
+    if hasattr(srtm4, "raster"):
+        monkeypatch.setattr(srtm4.raster, "SRTM_DIR", str(tmp_path))
+    monkeypatch.setattr(srtm4.download, "download", download)
+
+    with pytest.raises(ConnectionError):
+        srtm4.srtm4(2, 48)
@@ -56,3 +56,42 @@ def test_crop(bound, datum, expected_shape, tmp_path, monkeypatch):
         alts = np.reshape(srtm4.srtm4(x, y), raster_shape)
 
         np.testing.assert_allclose(raster[mask], alts[mask], atol=0, rtol=1e-2)
+
+
+def test_crop_more_tiles_than_open_limit(tmp_path, monkeypatch):
+    monkeypatch.setenv("SRTM4_CACHE", str(tmp_path))
+    monkeypatch.setattr(srtm4.raster, "MAX_OPEN_TILES", 2)
+
+    # 2 x 2 tiles, crossing the corner of 4 tiles
+    bound = (19.0, 44.0, 21.0, 46.0)
+    for _ in range(2):
+        raster, transform, crs = srtm4.crop(bound, datum="orthometric")
+        assert raster.shape == (2401, 2401)
+        assert not np.any(np.isnan(raster))
+
+    # the tiles not used anymore were closed down to the limit
+    datasets, users = srtm4.raster._thread_tiles()
+    assert len(datasets) <= 2
+    assert not users
+    assert all(not db.closed for db in datasets.values())
+
+
+def test_to_ellipsoid_grid(tmp_path, monkeypatch):
+    monkeypatch.setenv("SRTM4_CACHE", str(tmp_path))
+
+    bound = (21.33, -3.78, 21.66, -2.97)
+    raster, transform, crs = srtm4.crop(bound, datum="orthometric")
+    raster = raster.astype(np.float64)
+
+    # per pixel pyproj transformation
+    col = np.arange(raster.shape[1]) + 0.5
+    row = (np.arange(raster.shape[0]) + 0.5)[:, None]
+    a, b, c, d, e, f = transform[:6]
+    lon = a * col + b * row + c
+    lat = d * col + e * row + f
+    expected = srtm4.raster.to_ellipsoid(lon, lat, raster)
+
+    result = srtm4.raster.to_ellipsoid_grid(raster, transform)
+
+    mask = ~np.isnan(raster)
+    np.testing.assert_allclose(result[mask], expected[mask], atol=1e-3, rtol=0)